@@ -8,10 +8,34 @@ import time
 import bioval.utils.gpu_manager as gpu_manager
 import bioval.utils.distance as distance
 import bioval.utils.aggregation as aggregation
+import bioval.utils.fused_ranks as fused_ranks
 
 from scipy.stats import pearsonr
 
 
+def _intraclass_scores_core(matrix: torch.Tensor, thresholds: torch.Tensor) -> tuple:
+    """
+    Computes the rank-and-count core of the intraclass metric : the diagonal
+    ranks of the comparison matrix, the per-threshold counts, the mean rank and
+    the exact match count. Kept as a standalone function so it can be compiled
+    with torch.compile, fusing the comparison and the reductions into a single
+    pass over the matrix.
+
+    Args:
+
+        matrix (torch.Tensor): 2D tensor of distances between two arrays.
+        thresholds (torch.Tensor): 1D tensor of k thresholds.
+
+    Returns:
+
+        tuple: (counts, mean_ranks, exact_matches) tensors.
+    """
+    diagonal = matrix.diagonal()
+    ranks = (matrix < diagonal.unsqueeze(1)).sum(dim=1) + 1
+    mean_ranks = torch.mean(ranks.float(), dim=0)
+    counts = (ranks.unsqueeze(1) <= thresholds.unsqueeze(0)).sum(dim=0)
+    exact_matches = (ranks == 1).sum()
+    return counts, mean_ranks, exact_matches
 
 
 
@@ -56,6 +80,17 @@ class ConditionalEvaluation():
         self._methods = distance.get_distance_functions()
         self._distributed_methods = distance.get_distributed_distance_functions()
         self._aggregs = aggregation.get_aggregation_functions()
+        # small helper tensors (index ranges, diagonal masks, k thresholds)
+        # are cached per size and device, so repeated calls inside a training
+        # loop do not pay their allocation and host-to-device copy every time
+        self._tensor_cache = {}
+        # above this number of classes, intraclass ranks are computed tile by
+        # tile when the full distance matrix is not requested, bounding peak
+        # memory to chunk_size rows of the matrix at a time
+        self._chunked_ranks_threshold = 4096
+        self._chunked_ranks_chunk_size = 1024
+        # the intraclass rank-and-count core is compiled lazily on first use
+        self._compiled_intraclass_core = None
         self.inception = models.inception_v3(weights=models.Inception_V3_Weights.IMAGENET1K_V1, transform_input=False)
         # delete last layer of inception
         # Set the model to evaluation mode
@@ -66,6 +101,12 @@ class ConditionalEvaluation():
             raise ValueError(f"Distributed method {self._distributed_method} not available. Available methods are {list(self._distributed_methods.keys())}")
         if self._aggregate not in list(self._aggregs.keys()):
             raise ValueError(f"Aggregation method {self._aggregate} not available. Available aggregation methods are {list(self._aggregs.keys())}")
+        # resolve the configured functions once, instead of paying a dict
+        # lookup per call (and per pair in the distributional matrix); the
+        # setters rebind them when the configuration changes
+        self._method_fn = self._methods[self._method]
+        self._distributed_method_fn = self._distributed_methods[self._distributed_method]
+        self._aggregate_fn = self._aggregs[self._aggregate]
 
 
     @property
@@ -92,6 +133,7 @@ class ConditionalEvaluation():
         if value not in self._methods:
             raise ValueError("Invalid method, choose from {}".format(self._methods))
         self._method = value
+        self._method_fn = self._methods[value]
 
 
     @property
@@ -119,6 +161,56 @@ class ConditionalEvaluation():
         if value not in self._aggregs:
             raise ValueError("Invalid aggregation method, choose from {}".format(self._aggregs))
         self._aggregate = value
+        self._aggregate_fn = self._aggregs[value]
+
+
+    def _cached_tensor(self, key, factory):
+        """
+        Returns a small helper tensor from the instance cache, building it with
+        the given factory on first use.
+
+        Args:
+
+            key: A hashable key identifying the tensor, including its size and device.
+            factory: A zero-argument callable building the tensor on a cache miss.
+
+        Returns:
+
+            torch.Tensor: The cached tensor.
+        """
+        if key not in self._tensor_cache:
+            self._tensor_cache[key] = factory()
+        return self._tensor_cache[key]
+
+
+    def _run_intraclass_core(self, matrix, thresholds):
+        """
+        Runs the rank-and-count core of the intraclass metric, compiled with
+        torch.compile when available so the comparison and the reductions fuse
+        into a single pass over the matrix. Falls back to eager execution if
+        compilation is unsupported or fails on the current backend.
+
+        Args:
+
+            matrix (torch.Tensor): 2D tensor of distances between two arrays.
+            thresholds (torch.Tensor): 1D tensor of k thresholds.
+
+        Returns:
+
+            tuple: (counts, mean_ranks, exact_matches) tensors.
+        """
+        if self._compiled_intraclass_core is None:
+            if hasattr(torch, 'compile'):
+                self._compiled_intraclass_core = torch.compile(_intraclass_scores_core, dynamic=True)
+            else:
+                self._compiled_intraclass_core = _intraclass_scores_core
+        try:
+            return self._compiled_intraclass_core(matrix, thresholds)
+        except Exception:
+            # compilation backends are not available everywhere : pin the
+            # eager implementation and retry once
+            self._compiled_intraclass_core = _intraclass_scores_core
+            return _intraclass_scores_core(matrix, thresholds)
 
 
     def __call__(self, arr1: torch.Tensor, arr2: torch.Tensor, control = None, k_range=[1, 5, 10],aggregated=True,detailed_output=True,batch_size = 256,percent=0.1) -> dict:
@@ -151,9 +243,49 @@ class ConditionalEvaluation():
         >>> arr2 = torch.randn(100, 10)
         >>> print(topk(arr1, arr2, k_range=[1, 5, 10, 20, 50, 100]))
 
-        """   
+        """
         # check if format is correct and prepare data if its in image format
-        arr1,arr2,control = self._prepare_data_format(arr1, arr2,k_range,control,aggregated,batch_size)
+        arr1,arr2,control = self.prepare(arr1, arr2,control,k_range,aggregated,batch_size)
+        return self.score(arr1, arr2,control,k_range,aggregated,detailed_output,percent)
+
+
+    def prepare(self, arr1: torch.Tensor, arr2: torch.Tensor, control = None, k_range=[1, 5, 10],aggregated=True,batch_size = 256) -> tuple:
+        """
+        Validates the input tensors, extracts features from images and aggregates them once.
+        The returned tensors can be passed to score several times, so that pipelines scoring
+        the same arrays under multiple distance methods do not repeat the feature extraction
+        and the aggregation (median and robust mean in particular are not cheap) on every call.
+
+        Args:
+
+            - arr1: A torch.Tensor object of shape (N, I, H, W, C) or (N, H, W, C) or (N, I, F) or (N, F).
+            - arr2: A torch.Tensor object of shape (N, I, H, W, C) or (N, H, W, C) or (N, I, F) or (N, F).
+            - control: None, or a torch.Tensor object of shape (I, H, W, C) or (H, W, C) or (I, F) or (F).
+            - k_range (List[int]): A list of values for the range of k for intraclass scores.
+
+        Returns:
+
+            tuple: The prepared (arr1, arr2, control) tensors, ready to be passed to score.
+        """
+        return self._prepare_data_format(arr1, arr2,k_range,control,aggregated,batch_size)
+
+
+    def score(self, arr1: torch.Tensor, arr2: torch.Tensor, control = None, k_range=[1, 5, 10],aggregated=True,detailed_output=True,percent=0.1) -> dict:
+        """
+        Computes the metrics on tensors already validated and aggregated by prepare.
+        Calling the instance directly is equivalent to prepare followed by score.
+
+        Args:
+
+            - arr1: A torch.Tensor object as returned by prepare.
+            - arr2: A torch.Tensor object as returned by prepare.
+            - control: None, or a torch.Tensor object as returned by prepare.
+            - k_range (List[int]): A list of values for the range of k for intraclass scores.
+
+        Returns:
+
+            dict: A dictionary with the scores for each metric computed.
+        """
         dict_score = {}
         #### Control metric
         if control is not None:
@@ -162,14 +294,14 @@ class ConditionalEvaluation():
             #else:
                 # Mention that control metric is not available for non aggregated data yet in an warning message
                 #pass
-                
+
         #### Inter class metric
         dict_score = self._compute_interclass_scores(arr1, arr2,dict_score,aggregated,detailed_output)
         #### Intra class metric
         dict_score = self._compute_intraclass_scores(arr1, arr2,k_range,dict_score,aggregated,detailed_output)
         dict_score = self._compute_overall_distributed_score(arr1, arr2,dict_score,aggregated,percent)
         return dict_score
-    
+
 
     def _compute_interclass_scores(self,arr1: torch.Tensor, arr2: torch.Tensor,output : dict,aggregated=True,detailed_output=True) -> dict:
         """
@@ -192,8 +324,8 @@ class ConditionalEvaluation():
         """
         #### Inter class metric
         if aggregated:
-            matrix_1 = self._methods[self._method](arr1, arr1)
-            matrix_2 = self._methods[self._method](arr2, arr2)
+            matrix_1 = self._method_fn(arr1, arr1)
+            matrix_2 = self._method_fn(arr2, arr2)
         else:
             matrix_1 = self._distributional_distance_matrix(arr1, arr1)
             matrix_2 = self._distributional_distance_matrix(arr2, arr2)
@@ -203,8 +335,12 @@ class ConditionalEvaluation():
             output['interclass_matrix_2'] = matrix_2
         
         # delete the diagonal of each matrix
-        matrix_1 = matrix_1[~torch.eye(matrix_1.shape[0], dtype=bool)].view(matrix_1.shape[0], -1)
-        matrix_2 = matrix_2[~torch.eye(matrix_2.shape[0], dtype=bool)].view(matrix_2.shape[0], -1)
+        off_diagonal_1 = self._cached_tensor(('off_diagonal', matrix_1.shape[0], matrix_1.device),
+                                             lambda: ~torch.eye(matrix_1.shape[0], dtype=bool, device=matrix_1.device))
+        off_diagonal_2 = self._cached_tensor(('off_diagonal', matrix_2.shape[0], matrix_2.device),
+                                             lambda: ~torch.eye(matrix_2.shape[0], dtype=bool, device=matrix_2.device))
+        matrix_1 = matrix_1[off_diagonal_1].view(matrix_1.shape[0], -1)
+        matrix_2 = matrix_2[off_diagonal_2].view(matrix_2.shape[0], -1)
 
         # flatten the matrices
         matrix_1 = matrix_1.flatten()
@@ -245,10 +381,17 @@ class ConditionalEvaluation():
         output: A dictionary containing the results of the evaluation metric in addition to other metrics computed beforehand.
         """
         # get the matrix for comparison using the specified method
-        
-        if aggregated:
-            matrix = self._methods[self._method](arr1, arr2)
-            
+
+        # when the full matrix is neither returned nor ranked in detail, tile
+        # the distance computation over rows of arr1 so peak memory stays
+        # O(chunk * N) instead of O(N^2)
+        use_chunked = (aggregated and not detailed_output
+                       and arr1.shape[0] > self._chunked_ranks_threshold)
+        if use_chunked:
+            matrix = None
+        elif aggregated:
+            matrix = self._method_fn(arr1, arr2)
+
         else:
             matrix = self._distributional_distance_matrix(arr1, arr2)
             # Compute the mean of diagonal values
@@ -256,25 +399,53 @@ class ConditionalEvaluation():
             output["intra_" + self._distributed_method] = mean_diag.item()
         if detailed_output == True :
             output['matrix'] = matrix
-        # compute the diagonal ranks of the comparison matrix
-        ranks = self._compute_diag_ranks(matrix)
-        # compute the scores for each value in k_range
-        mean_ranks = torch.mean(ranks.float(), dim=0)
-        
-        # compute the scores for each value in k_range
-        for k in k_range :
-            number_values = k 
-            r = (ranks <= number_values).sum()
-            r = (r/matrix.shape[0]) * 100
-            output['intra_top'+str(k)] = r.item()
         if detailed_output == True :
+            # rank the diagonal and count the k thresholds in one pass,
+            # compiled with torch.compile when available
+            thresholds = self._cached_tensor(('k_thresholds', tuple(k_range), matrix.device),
+                                             lambda: torch.as_tensor(k_range, device=matrix.device))
+            counts, mean_ranks, r_exact = self._run_intraclass_core(matrix, thresholds)
+            # gather every intraclass scalar into one tensor and copy it to
+            # the host in a single transfer, then turn the raw values into
+            # percentages in Python : one sync instead of len(k_range) + 2
+            values = torch.cat([counts.float(),
+                                torch.stack([mean_ranks, r_exact.float()])]).tolist()
+            scale = 100.0 / matrix.shape[0]
+            for k, count in zip(k_range, values) :
+                output['intra_top'+str(k)] = count * scale
             # add the mean ranks score to the dictionary
-            output['mean_ranks'] = ((mean_ranks/matrix.shape[0]) * 100).item()
+            output['mean_ranks'] = values[-2] * scale
             # add the exact matching score to the dictionary
-            r_exact = (ranks == 1).sum()
-            output['exact_matching'] = ((r_exact/matrix.shape[0]) * 100).item()
-        
-        
+            output['exact_matching'] = values[-1] * scale
+        elif use_chunked :
+            # on CUDA with triton available, the euclidean method has a fused
+            # kernel that accumulates the diagonal ranks while streaming the
+            # distances, never materializing even a tile of the matrix
+            if self._method == 'euclidean' and fused_ranks.is_available(arr1, arr2):
+                ranks = fused_ranks.euclidean_diag_ranks(arr1, arr2)
+            else:
+                ranks = self._compute_diag_ranks_chunked(arr1, arr2)
+            thresholds = self._cached_tensor(('k_thresholds', tuple(k_range), ranks.device),
+                                             lambda: ranks.new_tensor(k_range))
+            counts = (ranks.unsqueeze(1) <= thresholds.unsqueeze(0)).sum(dim=0)
+            scale = 100.0 / arr1.shape[0]
+            for k, count in zip(k_range, counts.tolist()) :
+                output['intra_top'+str(k)] = count * scale
+        else :
+            # only the top-k membership of the diagonal is needed here, so a
+            # partial selection of the smallest max(k_range) entries per row
+            # is enough, avoiding a rank computation over every entry
+            kmax = min(max(k_range), matrix.shape[0])
+            indices = torch.topk(matrix, kmax, dim=1, largest=False, sorted=True).indices
+            diagonal_indices = self._cached_tensor(('arange', matrix.shape[0], matrix.device),
+                                                   lambda: torch.arange(matrix.shape[0], device=matrix.device))
+            hits = indices == diagonal_indices.unsqueeze(1)
+            counts = torch.stack([hits[:, :min(k, kmax)].any(dim=1).sum() for k in k_range])
+            scale = 100.0 / matrix.shape[0]
+            for k, count in zip(k_range, counts.tolist()) :
+                output['intra_top'+str(k)] = count * scale
+
+
         return output
 
 
@@ -311,11 +482,11 @@ class ConditionalEvaluation():
         else :
             distance_matrix_1 = np.zeros(arr1.shape[0])
             for i in range(arr1.shape[0]):
-                distance = self._distributed_methods[self._distributed_method](arr1[i], control)
+                distance = self._distributed_method_fn(arr1[i], control)
                 distance_matrix_1[i] = distance
             distance_matrix_2 = np.zeros(arr2.shape[0])
             for i in range(arr2.shape[0]):
-                distance = self._distributed_methods[self._distributed_method](arr2[i], control)
+                distance = self._distributed_method_fn(arr2[i], control)
                 distance_matrix_2[i] = distance
             
             
@@ -357,7 +528,7 @@ class ConditionalEvaluation():
                 arr1 = self._sample_uniformly(arr1, percent)
                 arr2 = self._sample_uniformly(arr2, percent)
 
-            distance = self._distributed_methods[self._distributed_method](arr1, arr2)
+            distance = self._distributed_method_fn(arr1, arr2)
             output["overall_" + self._distributed_method] = distance
         return output
 
@@ -467,18 +638,20 @@ class ConditionalEvaluation():
             raise ValueError(f"First tensor and second tensor should have the same number of features in dimension -1 but got {arr1.shape[-1]} and {arr2.shape[-1]} respectively")
         if control is not None and arr1.ndim in [2, 3] and control.ndim in [1, 2] and arr1.shape[-1] != control.shape[-1]:
             raise ValueError(f"First tensor and Control tensor should have the same number of features in dimension -1 but got {arr1.shape[-1]} and {control.shape[-1]} respectively")
-        # check if method and aggregate attributes are valid
-        if self._method not in self._methods and aggregated:
-            raise ValueError(f"{self._method} not in list of defined methods. Please choose from {list(self._methods.keys())}")
-        if self._aggregate not in self._aggregs and aggregated:
-            raise ValueError(f"{self._aggregate} not in list of defined aggregations. Please choose from {list(self._aggregs.keys())}")
         # aggregate the arrays if they are 3D tensors
         if arr1.ndim == 3 and aggregated:
-            arr1 = self._aggregs[self._aggregate](arr1)
+            arr1 = self._aggregate_fn(arr1)
         if arr2.ndim == 3 and aggregated:
-            arr2 = self._aggregs[self._aggregate](arr2)
+            arr2 = self._aggregate_fn(arr2)
         if control is not None and control.ndim == 2 and aggregated:
-            control = self._aggregs[self._aggregate](control,control=True) 
+            control = self._aggregate_fn(control,control=True)
+        # make sure the feature axis is the inner contiguous axis : slicing and
+        # aggregation can leave non-contiguous strides, which would push the
+        # distance matmuls onto slower packed fallback paths
+        arr1 = arr1.contiguous()
+        arr2 = arr2.contiguous()
+        if control is not None:
+            control = control.contiguous()
         return arr1,arr2,control
 
 
@@ -670,7 +843,7 @@ class ConditionalEvaluation():
         distance_matrix = np.zeros((x.shape[0], x.shape[0]))
         for i in range(x.shape[0]):
             for j in range(x.shape[0]):
-                distance = self._distributed_methods[self._distributed_method](x[i], y[j])
+                distance = self._distributed_method_fn(x[i], y[j])
                 distance_matrix[i, j] = distance
 
         # convert nd array to tensor
@@ -699,8 +872,10 @@ class ConditionalEvaluation():
 
         Returns:
 
-        torch.Tensor: 1D tensor of ranks of the diagonal elements in the input matrix. 
-                    Ranks start from 1, with 1 being the highest score.
+        torch.Tensor: 1D tensor of ranks of the diagonal elements in the input matrix.
+                    Ranks start from 1, with 1 being the highest score. The result
+                    stays on the device of the input matrix and is computed without
+                    any host synchronization.
 
         Example:
 
@@ -708,23 +883,44 @@ class ConditionalEvaluation():
         >>> _compute_diag_ranks(matrix)
         tensor([3, 3, 3])
         """
-        sorted_indices = torch.argsort(matrix, dim=1)
-        rank_indices = torch.argsort(sorted_indices, dim=1)
-        diagonal_indices = torch.arange(0,matrix.shape[0])
-        # check if rank_indices or diagonal_indices is on gpu and if one of them is on gpu, put the other on the same gpu
-        if rank_indices.device != diagonal_indices.device:
-            if rank_indices.device == 'cpu':
-                diagonal_indices = diagonal_indices.to(rank_indices.device)
-            else:
-                rank_indices = rank_indices.to(diagonal_indices.device)
-        diagonal_ranks = torch.gather(rank_indices,dim=1,index=diagonal_indices.view(-1,1)) +1        
-
-        #flatten the tensor
-        diagonal_ranks = diagonal_ranks.view(-1)
+        # The rank of each diagonal entry in its row is the number of entries
+        # in that row strictly smaller than it, plus one. A single broadcasted
+        # comparison replaces the double argsort, stays on the input device
+        # and avoids the sorting buffers.
+        diagonal = matrix.diagonal()
+        diagonal_ranks = (matrix < diagonal.unsqueeze(1)).sum(dim=1) + 1
 
         return diagonal_ranks
 
 
+    def _compute_diag_ranks_chunked(self, arr1: torch.Tensor, arr2: torch.Tensor) -> torch.Tensor:
+        """
+        Computes the diagonal ranks of the comparison matrix between arr1 and arr2
+        without materializing the full (N, N) matrix. The rows of arr1 are processed
+        in tiles : each tile of the matrix is computed with the configured distance
+        method, reduced to the ranks of its diagonal entries, and discarded.
+
+        Args:
+
+        arr1: A tensor representing the first set of embeddings, with shape (N,F).
+        arr2: A tensor representing the second set of embeddings, with shape (N,F).
+
+        Returns:
+
+        torch.Tensor: 1D tensor of ranks of the diagonal elements, as returned by
+                    _compute_diag_ranks, with peak memory bounded by one tile of
+                    the matrix instead of the whole matrix.
+        """
+        n = arr1.shape[0]
+        chunk = self._chunked_ranks_chunk_size
+        ranks = torch.empty(n, dtype=torch.long, device=arr1.device)
+        for start in range(0, n, chunk):
+            tile = self._method_fn(arr1[start:start + chunk], arr2)
+            diagonal = tile.diagonal(offset=start)
+            ranks[start:start + chunk] = (tile < diagonal.unsqueeze(1)).sum(dim=1) + 1
+        return ranks
+
+
     @staticmethod
     def _compute_pearson_correlation(matrix_1, matrix_2):
         """
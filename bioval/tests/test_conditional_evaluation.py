@@ -114,6 +114,29 @@ class TestConditionalEvaluation(unittest.TestCase):
         control_score_2 = output['class_control_scores']
         self.assertIsInstance(control_score_2, list)
 
+    def test_prepare_score(self):
+        arr1 = torch.Tensor([
+            [1, 2, 3],
+            [4, 5, 6],
+            [7, 8, 9]
+        ])
+        arr2 = torch.Tensor([
+            [9, 8, 7],
+            [6, 5, 4],
+            [3, 2, 1]
+        ])
+        topk = ConditionalEvaluation()
+
+        # prepare once, score on the prepared tensors
+        prepared_1, prepared_2, prepared_control = topk.prepare(arr1, arr2, k_range=[1, 5, 10])
+        self.assertIsNone(prepared_control)
+        output = topk.score(prepared_1, prepared_2, k_range=[1, 5, 10])
+
+        # calling the instance directly should give the same scores
+        expected = topk(arr1, arr2, k_range=[1, 5, 10])
+        self.assertEqual(output['intra_top1'], expected['intra_top1'])
+        self.assertEqual(output['inter_corr'], expected['inter_corr'])
+
 if __name__ == '__main__':
     unittest.main(argv=[''], verbosity=2, exit=False)
     # call TestTopKDistance.test_init
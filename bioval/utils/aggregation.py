@@ -1,5 +1,33 @@
 import torch
 
+def _geometric_mean(emb: torch.Tensor, dim: int) -> torch.Tensor:
+    """Compute the geometric mean of embeddings along a dimension.
+
+    Clamping replaces the epsilon add of the previous formulation, saving one
+    elementwise pass, and the helper is a single log/mean/exp chain that
+    torch.compile can fuse into one pass over the input when available.
+
+    Args:
+        emb (torch.Tensor): a tensor of positive embeddings
+        dim (int): the dimension to reduce
+
+    Returns:
+        torch.Tensor: the geometric mean of emb along dim
+    """
+    return torch.exp(torch.log(emb.clamp_min(1e-8)).mean(dim=dim))
+
+_geometric_mean_fn = torch.compile(_geometric_mean, dynamic=True) if hasattr(torch, 'compile') else _geometric_mean
+
+def _geometric_mean_safe(emb: torch.Tensor, dim: int) -> torch.Tensor:
+    """Run the geometric mean, falling back to eager execution if the
+    compiled version is unsupported on the current backend."""
+    global _geometric_mean_fn
+    try:
+        return _geometric_mean_fn(emb, dim)
+    except Exception:
+        _geometric_mean_fn = _geometric_mean
+        return _geometric_mean(emb, dim)
+
 def get_aggregation_functions() -> dict:
     """Returns a dictionary containing aggregation functions.
 
@@ -61,13 +89,9 @@ def robust_mean(emb: torch.Tensor, control: bool = False) -> torch.Tensor:
         torch.Tensor: a tensor of shape (N, D) or (D), depending on the value of control
     """
     if emb.ndim == 3:
-        log_embeddings = torch.log(emb + 1e-8)
-        avg_log_embeddings = torch.mean(log_embeddings, dim=1)
-        return torch.exp(avg_log_embeddings)
+        return _geometric_mean_safe(emb, dim=1)
     elif emb.ndim == 2 and control:
-        log_embeddings = torch.log(emb + 1e-8)
-        avg_log_embeddings = torch.mean(log_embeddings, dim=0)
-        return torch.exp(avg_log_embeddings)
+        return _geometric_mean_safe(emb, dim=0)
     else:
         return emb
 
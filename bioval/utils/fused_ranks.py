@@ -0,0 +1,91 @@
+import torch
+
+# triton is optional : when available (it ships with CUDA builds of torch),
+# the diagonal ranks of the euclidean comparison matrix can be computed in a
+# single fused kernel that never materializes the (N, N) matrix
+try:
+    import triton
+    import triton.language as tl
+    _HAS_TRITON = True
+except ImportError:
+    _HAS_TRITON = False
+
+
+if _HAS_TRITON:
+    @triton.jit
+    def _euclidean_rank_kernel(a_ptr, b_ptr, a2_ptr, b2_ptr, diag2_ptr, ranks_ptr,
+                               n, d, stride_an, stride_bn,
+                               BLOCK_J: tl.constexpr, BLOCK_D: tl.constexpr):
+        # one program per row i of the comparison matrix : stream the row in
+        # tiles of BLOCK_J columns, rebuild each squared distance from the
+        # precomputed squared norms and a dot product, and count the entries
+        # strictly smaller than the diagonal one
+        i = tl.program_id(0)
+        a2_i = tl.load(a2_ptr + i)
+        diag2_i = tl.load(diag2_ptr + i)
+        count = 0
+        for j0 in range(0, n, BLOCK_J):
+            offs_j = j0 + tl.arange(0, BLOCK_J)
+            mask_j = offs_j < n
+            acc = tl.zeros((BLOCK_J,), dtype=tl.float32)
+            for d0 in range(0, d, BLOCK_D):
+                offs_d = d0 + tl.arange(0, BLOCK_D)
+                mask_d = offs_d < d
+                a = tl.load(a_ptr + i * stride_an + offs_d, mask=mask_d, other=0.0)
+                b = tl.load(b_ptr + offs_j[:, None] * stride_bn + offs_d[None, :],
+                            mask=mask_j[:, None] & mask_d[None, :], other=0.0)
+                acc += tl.sum(a[None, :] * b, axis=1)
+            b2_j = tl.load(b2_ptr + offs_j, mask=mask_j, other=0.0)
+            dji2 = a2_i + b2_j - 2.0 * acc
+            smaller = mask_j & (offs_j != i) & (dji2 < diag2_i)
+            count += tl.sum(tl.where(smaller, 1, 0))
+        tl.store(ranks_ptr + i, count + 1)
+
+
+def is_available(arr1: torch.Tensor, arr2: torch.Tensor) -> bool:
+    """
+    Returns whether the fused diagonal-rank kernel applies to the given pair of tensors.
+
+    Args:
+        arr1 (torch.Tensor): A tensor of shape (n_samples, n_features).
+        arr2 (torch.Tensor): A tensor of shape (n_samples, n_features).
+
+    Returns:
+        bool: True when triton is installed and both tensors are 2D CUDA tensors
+        of the same shape.
+    """
+    return (_HAS_TRITON
+            and arr1.is_cuda
+            and arr2.is_cuda
+            and arr1.ndim == 2
+            and arr1.shape == arr2.shape)
+
+
+def euclidean_diag_ranks(arr1: torch.Tensor, arr2: torch.Tensor) -> torch.Tensor:
+    """
+    Computes the diagonal ranks of the euclidean comparison matrix between two
+    tensors in one fused kernel. For each row i, the kernel streams the squared
+    distances of row i in tiles, counting those strictly smaller than the
+    diagonal entry, so the full (N, N) matrix is never materialized : memory
+    traffic is O(N * F) per row instead of O(N^2) overall.
+
+    Args:
+        arr1 (torch.Tensor): A CUDA tensor of shape (n_samples, n_features).
+        arr2 (torch.Tensor): A CUDA tensor of shape (n_samples, n_features).
+
+    Returns:
+        torch.Tensor: 1D tensor of ranks of the diagonal elements, starting from 1,
+        matching the output of ConditionalEvaluation._compute_diag_ranks for the
+        euclidean method.
+    """
+    a = arr1.contiguous().float()
+    b = arr2.contiguous().float()
+    n, d = a.shape
+    a2 = (a * a).sum(-1)
+    b2 = (b * b).sum(-1)
+    diag2 = ((a - b) * (a - b)).sum(-1)
+    ranks = torch.empty(n, dtype=torch.int32, device=a.device)
+    _euclidean_rank_kernel[(n,)](a, b, a2, b2, diag2, ranks,
+                                 n, d, a.stride(0), b.stride(0),
+                                 BLOCK_J=128, BLOCK_D=64)
+    return ranks.long()